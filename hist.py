@@ -1,6 +1,113 @@
 """ A class for building histograms incrementally. """
+import math
+import threading
 import numpy as np
-from collections import defaultdict
+
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:
+    njit = None
+
+# Batches smaller than this are counted on a single thread; 
+# below it thread start-up costs more than it saves. So are 
+# batches with fewer samples than (bins spanned x threads), as
+# each thread needs its own copy of those bins, and batches 
+# added from other threads (which are presumably already 
+# running in parallel); numba's thread pool isn't safe to 
+# start from them anyway.
+_PARALLEL_MIN = 1 << 16
+
+# The most bins a histogram may span (i.e. 512 MB of int32 counts).
+_MAX_BINS = 1 << 27
+
+# Count arrays handed back by RHist.release(), kept for reuse by
+# other histograms (see _alloc).  Only smallish arrays are kept, 
+# and only a few of them.
+_POOL = []
+_POOL_MAX = 16
+_POOL_MAX_SIZE = 1 << 20
+
+# Guards _POOL, so two threads never get the same array.
+_POOL_LOCK = threading.Lock()
+
+
+def _alloc(size, dtype):
+    """ Return a zeroed count array of (at least) <size> bins, reusing
+    one from _POOL if there is one no more than twice that size. """
+
+    with _POOL_LOCK:
+        for i, counts in enumerate(_POOL):
+            if (size <= counts.size <= 2 * size) and (counts.dtype == dtype):
+                del _POOL[i]
+                counts.fill(0)
+                return counts
+
+    return np.zeros(size, dtype=dtype)
+
+
+# matplotlib is only needed (and imported) for plotting.
+_plt = None
+
+
+def _get_plt():
+    """ Return matplotlib.pyplot, importing it on first use. """
+
+    global _plt
+    if _plt is None:
+        import matplotlib.pyplot as plt
+        _plt = plt
+
+    return _plt
+
+
+if njit is not None:
+    @njit(nogil=True, cache=True)
+    def _add_one(counts, lo_idx, x, scale):
+        """ Count <x> in <counts> if its bin is already there.
+
+        Returns the bin index of <x> and whether it was counted. """
+
+        # NaN and inf have no bin; leave them to add() to report.
+        if not np.isfinite(x):
+            return 0, False
+
+        idx = int(np.rint(x * scale))
+        i = idx - lo_idx
+        if (i < 0) or (i >= counts.shape[0]):
+            return idx, False
+
+        counts[i] += 1
+
+        return idx, True
+
+
+    @njit(nogil=True, cache=True)
+    def _scatter_add(idx, lo_idx, counts):
+        """ Count the bin indices <idx> into <counts>, in place. """
+
+        for j in range(idx.shape[0]):
+            counts[idx[j] - lo_idx] += 1
+
+
+    @njit(parallel=True, nogil=True, cache=True)
+    def _bincount_parallel(idx, lo_idx, counts, nchunks):
+        """ Count the bin indices <idx> into <counts>, splitting <idx> 
+        into <nchunks> chunks that are each counted on their own 
+        thread then summed. 
+
+        Pass only the slice of counts the batch spans (starting at bin
+        <lo_idx>), as each thread keeps a copy that size. """
+
+        n = idx.shape[0]
+        step = (n + nchunks - 1) // nchunks
+        local = np.zeros((nchunks, counts.shape[0]), dtype=np.int64)
+        for c in prange(nchunks):
+            for j in range(c * step, min((c + 1) * step, n)):
+                local[c, idx[j] - lo_idx] += 1
+
+        for c in range(nchunks):
+            for i in range(counts.shape[0]):
+                counts[i] += local[c, i]
 
 
 class RHist():
@@ -18,39 +125,273 @@ class RHist():
 
     <decimals> is an integer specifying the number of decimal places.
     Negative numbers behave as expected.  
+
+    Bins are stored by their integer index, round(x * 10**decimals),
+    so two values land in the same bin only if they round to the same
+    integer; bin values (e.g. the keys of .h) are only made on output.
+    Every bin between the smallest and largest value is stored, so the
+    data may span at most 2**27 bins (e.g. +/-6.7e5 with decimals=2); 
+    adding data beyond that raises a ValueError.
+
+    <count_dtype> is the integer type used to store the counts. It is 
+    widened to int64 (in place) once the counts could overflow it.
     """
 
-    def __init__(self,name,decimals=1):
+    def __init__(self,name,decimals=1,count_dtype=np.int32):
         self.decimals = decimals
         self.name = name
 
-        self.h = defaultdict(int)
-        self.h_norm = None
+        # Bins sit on a regular grid with spacing 10**-decimals so
+        # counts are kept in a dense array indexed by the integer
+        # bin number (i.e. round(x * scale)), offset by lo_idx.
+        self.scale = 10.0 ** decimals
+        self.counts = np.zeros(0, dtype=count_dtype)
+        self.lo_idx = 0
+        if self.counts.dtype.kind not in 'iu':
+            raise ValueError("count_dtype must be an integer type")
+
+        # No bin can hold more than n, so once n reaches
+        # this the counts are widened (see _promote).
+        self._count_max = int(np.iinfo(self.counts.dtype).max)
+
+        # Use the compiled add() kernel when numba is around.
+        self._fast = njit is not None
+
+        # Running moments of the (binned) data, updated as
+        # data arrives so that n, mean and var are O(1).
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+        # Derived values cached by _memo(); bumping _ver on
+        # every update invalidates them.
+        self._ver = 0
+        self._cache = {}
+
+
+    def reset(self):
+        """ Empty the histogram, keeping its bins for reuse. """
+
+        self.counts.fill(0)
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._ver += 1
+
+
+    def release(self):
+        """ Empty the histogram, handing its bins to the pool for 
+        reuse by other histograms (e.g. when it's no longer needed). 
+        
+        Any reference to the old .counts must not be used after. """
+
+        counts = self.counts
+        self.counts = np.zeros(0, dtype=counts.dtype)
+        self.lo_idx = 0
+        self.reset()
+
+        with _POOL_LOCK:
+            if ((len(_POOL) < _POOL_MAX) and 
+                    (0 < counts.size <= _POOL_MAX_SIZE)):
+                _POOL.append(counts)
+
+
+    @property
+    def h(self):
+        """ The histogram as a dict of {bin: count}, built on demand. """
+
+        nonzero = np.flatnonzero(self.counts)
+
+        return dict(zip(
+                self._centers()[nonzero].tolist(),
+                self.counts[nonzero].tolist()))
+
+
+    def _centers(self):
+        """ Return the value of each bin in self.counts. """
+
+        return self._memo('centers', lambda: 
+                (np.arange(self.counts.size) + self.lo_idx) / self.scale)
+
+
+    def _memo(self, key, fn):
+        """ Return fn(), cached under <key> until the next update. """
+
+        cache = self._cache
+        if cache.get('_ver') != self._ver:
+            cache.clear()
+            cache['_ver'] = self._ver
+        if key not in cache:
+            cache[key] = fn()
+
+        return cache[key]
+
+
+    def _cumsum(self):
+        """ Return the cumulative counts. """
+
+        return self._memo('cumsum', lambda: np.cumsum(self.counts))
+
+
+    def _grow(self, lo, hi):
+        """ Make sure self.counts covers the bin indices <lo> to <hi>. """
+
+        size = self.counts.size
+        old_hi = self.lo_idx + size - 1
+        if size == 0:
+            new_lo, new_hi = lo, hi
+        elif (lo >= self.lo_idx) and (hi <= old_hi):
+            return
+        else:
+            new_lo, new_hi = min(lo, self.lo_idx), max(hi, old_hi)
+
+        # Every bin between the extremes gets stored, so data 
+        # spread too widely for <decimals> can't be held.
+        span = new_hi - new_lo + 1
+        if span > _MAX_BINS:
+            raise ValueError(
+                    ("The data would span {0} bins, more than the {1} "
+                    "allowed; use fewer decimals").format(span, _MAX_BINS))
+
+        if size == 0:
+            self.counts = _alloc(span, self.counts.dtype)
+            self.lo_idx = lo
+            return
+
+        # Grow to (at least) double the size, so a run of new 
+        # extremes costs amortized O(1) per bin, putting the 
+        # extra bins on the side(s) the data grew toward.
+        extra = min(max(2 * size - span, 0), _MAX_BINS - span)
+        if (lo < self.lo_idx) and (hi > old_hi):
+            new_lo -= extra // 2
+            new_hi += extra - (extra // 2)
+        elif lo < self.lo_idx:
+            new_lo -= extra
+        else:
+            new_hi += extra
+
+        # Copy the old counts into place in the larger array.
+        counts = _alloc(new_hi - new_lo + 1, self.counts.dtype)
+        offset = self.lo_idx - new_lo
+        counts[offset:offset + size] = self.counts
+
+        self.counts = counts
+        self.lo_idx = new_lo
+
+
+    def _promote(self):
+        """ Widen the counts to int64 so they can't overflow. """
+
+        self.counts = self.counts.astype(np.int64)
+        self._count_max = int(np.iinfo(np.int64).max)
 
 
     def add(self,x):
         """ Add <x>, a data point, to the histogram """
 
-        # Do type checking here?
-        self.h[np.round(x,self.decimals)] += 1
+        if self._n >= self._count_max:
+            self._promote()
+
+        # Do type checking here? Binning is always done in float64 
+        # (as in add_many) so e.g. float32 data lands in the same 
+        # bins, whichever path counts it.
+        x = float(x)
+        counted = False
+        if self._fast:
+            idx, counted = _add_one(self.counts, self.lo_idx, x, self.scale)
+
+        if not counted:
+            if not math.isfinite(x):
+                raise ValueError("Data must be finite, got {0}".format(x))
+
+            # The builtin round() rounds half to even, like
+            # np.rint, but skips the ufunc machinery.
+            idx = round(x * self.scale)
+            i = idx - self.lo_idx
+            if not (0 <= i < self.counts.size):
+                # <x> fell outside the current bins.
+                self._grow(idx, idx)
+                i = idx - self.lo_idx
+            self.counts[i] += 1
+
+        # Welford's update, using the binned value of <x>.
+        value = idx / self.scale
+        self._n += 1
+        delta = value - self._mean
+        self._mean += delta / self._n
+        self._m2 += delta * (value - self._mean)
+        self._ver += 1
+
+
+    def add_many(self,xs):
+        """ Add <xs>, a sequence of data points, to the histogram 
+
+        Separate histograms can be filled from separate threads 
+        (e.g. with ThreadPoolExecutor), though a single histogram 
+        must not be updated from two threads. With numba installed
+        the counting kernels release the GIL, so this can scale; 
+        without it np.bincount does the counting, and may not. """
+
+        xs = np.asarray(xs, dtype=float).ravel()
+        if not np.isfinite(xs).all():
+            raise ValueError("Data must be finite")
+
+        idx = np.rint(xs * self.scale).astype(np.int64)
+        if idx.size == 0:
+            return
+        if (self._n + idx.size) > self._count_max:
+            self._promote()
+
+        # Grow once to fit the whole batch, then count
+        # every bin in a single pass.
+        lo, hi = int(idx.min()), int(idx.max())
+        self._grow(lo, hi)
+
+        # Only count over the batch's own range of bins.
+        start = lo - self.lo_idx
+        view = self.counts[start:start + (hi - lo) + 1]
+        if (self._fast and (idx.size >= _PARALLEL_MIN) and 
+                (threading.current_thread() is threading.main_thread()) and
+                (get_num_threads() * view.size <= idx.size)):
+            # Each thread keeps its own copy of view, so this only
+            # pays off when the batch is dense over its range.
+            _bincount_parallel(idx, lo, view, get_num_threads())
+        elif self._fast:
+            _scatter_add(idx, lo, view)
+        else:
+            # (The cast is safe, add_many has already promoted 
+            # the counts if they could overflow.)
+            np.add(view, np.bincount(idx - lo, minlength=view.size), 
+                    out=view, casting='unsafe')
+
+        # Merge the batch moments into the running ones
+        # (Chan et al's pairwise update).
+        values = idx / self.scale
+        n_batch = idx.size
+        mean_batch = values.mean()
+        m2_batch = np.dot(values - mean_batch, values - mean_batch)
+
+        n = self._n + n_batch
+        delta = mean_batch - self._mean
+        self._mean += delta * n_batch / n
+        self._m2 += m2_batch + delta ** 2 * self._n * n_batch / n
+        self._n = n
+        self._ver += 1
 
 
     def norm(self):
         """ 
-        Calculate the normalized histogram (i.e. a probability
-        mass function). 
+        Calculate and return the normalized histogram (i.e. a 
+        probability mass function) as a dict of {bin: p}. 
         """
-        from copy import deepcopy
         # Borrowed from the implementation discussed in 
         # Think Stats Probability and Statistics for Programmers
         # By Allen B. Downey, p 16.
         # http://shop.oreilly.com/product/0636920020745.do
         
-        self.h_norm = deepcopy(self.h)
-
         weight = 1./self.n()
-        for k in self.h_norm.keys():
-            self.h_norm[k] *= weight
+
+        return dict((k, c * weight) for k, c in self.h.items())
 
 
     def mean(self):
@@ -60,37 +401,36 @@ class RHist():
         # By Allen B. Downey, p 16.
         # http://shop.oreilly.com/product/0636920020745.do
 
-        if self.h_norm is None:
-            self.norm()
+        # Like var, there's no mean of an empty histogram.
+        if self.n() == 0:
+            raise ZeroDivisionError("The histogram is empty")
 
-        mean = 0.0
-        for x, p in self.h_norm.items():
-
-            # mean = sum_i(p_i*x_i)
-            mean += p * x
-        
-        return mean
+        # mean = sum_i(p_i*x_i), kept up to date by add/add_many.
+        return self._mean
     
     
     def median(self):
         """ Estimate and return the median. """
         
-        # Get all the key values
-        # and sort them.
-        values = self.h.keys()
-        values = sorted(values)
-        
-        # And count them too
-        nvalues = len(values)
+        if self.n() == 0:
+            raise ZeroDivisionError("The histogram is empty")
 
-        # If even:
-        if (nvalues % 2) == 0:
-            median = (values[nvalues / 2] + values[(nvalues / 2) + 1]) / 2.0
-        # Or odd
-        else:
-            median = values[(nvalues + 1) / 2]
+        return self._memo('median', self._median)
+
+
+    def _median(self):
+        """ Find the median from the cumulative counts. """
+
+        n = self.n()
+        cum = self._cumsum()
+
+        # Find the bins holding the middle sample(s), i.e. 
+        # rank (n + 1) / 2 if n is odd, or ranks n / 2 and 
+        # n / 2 + 1 if even, then average them.
+        lower = np.searchsorted(cum, (n + 1) // 2)
+        upper = np.searchsorted(cum, (n // 2) + 1)
         
-        return median
+        return (lower + upper + 2 * self.lo_idx) / (2.0 * self.scale)
     
     
     def var(self):
@@ -100,22 +440,15 @@ class RHist():
         # By Allen B. Downey, p 16.
         # http://shop.oreilly.com/product/0636920020745.do
 
-        if self.h_norm is None:
-            self.norm()
-
-        # var = sum_i(p_i * (x_i - mean)*2)
-        mean = self.mean()
-        var = 0.0
-        for x, p in self.h_norm.items():
-            var += p * (x - mean) ** 2
-        
-        return var
+        # var = sum_i(p_i * (x_i - mean)*2), kept up to 
+        # date (as a sum of squares) by add/add_many.
+        return self._m2 / float(self.n())
 
         
     def n(self):
-        """ Count and return the total number of samples. """
+        """ Return the total number of samples. """
 
-        return np.sum(self.h.values())
+        return self._n
 
 
     def stdev(self):
@@ -140,11 +473,12 @@ class RHist():
         """ Estimate and return the percent area of the histogram at 
         or above the <criterion>. """
         
-        # If the bin is at or above, add to the list of values
-        # the sum and norm the values.
-        values = [value for key, value in self.h.items() if key >= criterion]
+        # Find the first bin at or above the criterion; everything
+        # before it (i.e. cum[i - 1]) is below, the rest above.
+        i = np.searchsorted(self._centers(), criterion)
+        below = self._cumsum()[i - 1] if i > 0 else 0
         
-        return np.sum(values) / float(self.n())
+        return (self.n() - below) / float(self.n())
 
 
     def overlap(self, Rhist):
@@ -154,26 +488,29 @@ class RHist():
         Note: percent overlap is calculated by finding the difference
         in absolute counts for all overlapping bins, summing these, 
         then normalizing by the total counts for both distributions
-        (all bins). """
+        (all bins). Both histograms must have the same <decimals>. """
         
+        if self.decimals != Rhist.decimals:
+            raise ValueError("Both histograms must use the same decimals")
+
         n1 = self.n()  ## Get total counts
         n2 = Rhist.n()
         
-        # Tabulate the diffs for each
-        # overlapping bin.
-        diffs = []
-        for key, val1 in self.h.items():
-            try:
-                val2 = Rhist.h[key]
-            except KeyError:
-                pass
-            else:
-                val1 = float(val1)
-                val2 = float(val2)
-                diffs.append(max(val1, val2) - np.abs(val1 - val2))
-        
+        # Find the range of bins the two share, 
+        # and line up their counts.
+        lo = max(self.lo_idx, Rhist.lo_idx)
+        hi = min(self.lo_idx + self.counts.size, 
+                Rhist.lo_idx + Rhist.counts.size)
+        if hi <= lo:
+            return 0.0
+
+        c1 = self.counts[lo - self.lo_idx:hi - self.lo_idx]
+        c2 = Rhist.counts[lo - Rhist.lo_idx:hi - Rhist.lo_idx]
+
+        # Tabulate the diffs for each overlapping bin,
+        # i.e. max(c1, c2) - |c1 - c2| == min(c1, c2).
         # Sum, then normalize by total count.
-        return np.sum(diffs) / (n1 + n2)
+        return np.minimum(c1, c2).sum() / float(n1 + n2)
 
     
     def fitPDF(self, family):
@@ -193,18 +530,22 @@ class RHist():
         <norm> indicates whether the raw counts or normalized values 
         should be plotted.
         """
-        import matplotlib.pyplot as plt
+        plt = _get_plt()
 
         plt.ion()
             ## Interactive plots -- go.
 
-        xs = []; ys = []
+        # The dense counts are already sorted by bin.
+        xs = self._centers()
+        ys = self.counts
         if norm is True:
-            if self.h_norm is None: 
-                self.norm()
-            xs,ys = zip(*sorted(self.h_norm.items()))
-        else:
-            xs,ys = zip(*sorted(self.h.items()))
+            ys = ys / float(self.n())
+
+        # Skip any empty bins at either end.
+        nonzero = np.flatnonzero(ys)
+        if nonzero.size > 0:
+            xs = xs[nonzero[0]:nonzero[-1] + 1]
+            ys = ys[nonzero[0]:nonzero[-1] + 1]
 
         ax = None
         if fig is None:
@@ -213,9 +554,8 @@ class RHist():
         else:
             ax = fig.axes[0]
 
-        # Find the min width for bars. And plot!
-        width = min(
-            [xs[ii+1] - xs[ii] for ii in range(len(xs)-1)])
+        # Bars are one bin wide. And plot!
+        width = 1.0 / self.scale
         ax.bar(xs,ys,
                 width=width,
                 alpha=0.4,
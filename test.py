@@ -5,7 +5,7 @@ def test_RHist():
 
 	xs = stats.norm.rvs(size=10000)
 	rh = RHist(name='test',decimals=1)
-	[rh.incr(x) for x in xs]
+	rh.add_many(xs)
 
 	print('The normal distribution was sampled 10,000 times....')
 	print('Est. Mean (0): {0}'.format(rh.mean()))
@@ -16,4 +16,246 @@ def test_RHist():
 
 	fig = rh.plot(fig=None,norm=True)
 
-	# TODO: Add a uniform and some asymmetric dist too.
\ No newline at end of file
+	# TODO: Add a uniform and some asymmetric dist too.
+
+def _filled(xs, decimals=1, how='add_many', **kwargs):
+	""" Return a RHist of <xs>, filled by <how>. """
+	from bigstats.hist import RHist
+
+	rh = RHist(name=how,decimals=decimals,**kwargs)
+	if how == 'add_many':
+		rh.add_many(xs)
+	elif how == 'add':
+		[rh.add(x) for x in xs]
+	elif how == 'slow':
+		rh._fast = False
+		[rh.add(x) for x in xs]
+	
+	return rh
+
+
+def test_RHist_paths():
+	import numpy as np
+
+	xs = np.random.RandomState(42).normal(loc=2,scale=3,size=2001)
+	rounded = np.round(xs, 1)
+
+	# add, add_many and the pure-Python path should all 
+	# agree with each other, and with np.round.
+	for how in ('add_many', 'add', 'slow'):
+		rh = _filled(xs, how=how)
+		assert rh.n() == xs.size
+		assert np.isclose(rh.mean(), rounded.mean())
+		assert np.isclose(rh.var(), rounded.var())
+		assert np.isclose(rh.median(), np.median(rounded))
+		assert np.isclose(rh.above(2.0), (rounded >= 2.0).mean())
+		assert rh.h == _filled(xs).h
+
+	# Batched, with the pure-Python (bincount) path too.
+	rh = _filled(xs[:1000])
+	rh._fast = False
+	rh.add_many(xs[1000:])
+	assert rh.h == _filled(xs).h
+	assert np.isclose(rh.var(), rounded.var())
+
+
+def test_RHist_median():
+	import numpy as np
+
+	# Medians are weighted by count, for odd and even n.
+	for xs in ([1, 1, 2, 5], [1, 2, 2, 5, 9], [3], [-4, -4, 8, 9, 10, 10]):
+		for how in ('add_many', 'add', 'slow'):
+			rh = _filled(xs, decimals=0, how=how)
+			assert rh.median() == np.median(xs)
+
+
+def test_RHist_nonfinite():
+	for x in (float('nan'), float('inf')):
+		for how in ('add_many', 'add', 'slow'):
+			try:
+				_filled([1.0, x], how=how)
+			except ValueError:
+				pass
+			else:
+				assert False, "{0} should be rejected".format(x)
+
+
+def test_RHist_span():
+	# Data too spread out to store densely is refused, 
+	# leaving the histogram as it was.
+	for how in ('add_many', 'add', 'slow'):
+		try:
+			_filled([0.0, 1e9], decimals=2, how=how)
+		except ValueError:
+			pass
+		else:
+			assert False, "1e9 bins should be refused"
+
+	rh = _filled([0.0, 1.0], decimals=2)
+	for add in (rh.add, lambda x: rh.add_many([x])):
+		try:
+			add(1e9)
+		except ValueError:
+			pass
+		else:
+			assert False, "1e9 bins should be refused"
+		assert rh.h == {0.0: 1, 1.0: 1}
+		assert rh.mean() == 0.5
+
+
+def test_RHist_empty():
+	from bigstats.hist import RHist
+
+	# Nothing to estimate from an empty histogram.
+	rh = RHist(name='empty',decimals=1)
+	for stat in (rh.mean, rh.median, rh.var):
+		try:
+			stat()
+		except ZeroDivisionError:
+			pass
+		else:
+			assert False, "{0}() of an empty histogram".format(stat.__name__)
+
+
+def test_RHist_overlap():
+	rh1 = _filled([1, 1, 2, 5], decimals=0)
+	rh2 = _filled([2, 2, 5, 7, -3], decimals=0)
+	assert rh1.overlap(rh2) == 2 / 9.
+	assert rh2.overlap(rh1) == 2 / 9.
+
+	try:
+		rh1.overlap(_filled([1, 2], decimals=1))
+	except ValueError:
+		pass
+	else:
+		assert False, "overlap() should reject different decimals"
+
+
+def test_RHist_reset():
+	rh = _filled([1, 2, 3])
+	rh.reset()
+	assert rh.n() == 0
+	assert rh.h == {}
+
+	rh.add_many([4, 4, 5])
+	assert rh.h == {4.0: 2, 5.0: 1}
+	assert rh.median() == 4.0
+
+
+def test_RHist_release():
+	import numpy as np
+	import bigstats.hist as hist
+
+	del hist._POOL[:]
+	try:
+		rh = _filled(np.arange(100) / 10.)
+		counts = rh.counts
+		rh.release()
+		assert rh.n() == 0
+		assert rh.h == {}
+		assert any(c is counts for c in hist._POOL)
+
+		# The released 100 bins aren't reused for more than 100, 
+		# fewer than 50, or with a different dtype...
+		for xs, kwargs in (
+				(np.arange(300) / 10., {}),
+				([1, 2], {}),
+				(np.arange(60) / 10., {'count_dtype': np.int64})):
+			assert _filled(xs, **kwargs).counts is not counts
+
+		# ...but are for 60, with the old counts cleared.
+		xs = np.arange(60) / 10.
+		reused = _filled(xs)
+		assert reused.counts is counts
+		assert reused.h == _filled(xs).h
+		assert reused.n() == 60
+	finally:
+		del hist._POOL[:]
+
+
+def test_RHist_promote():
+	import numpy as np
+
+	# uint8 counts must widen before passing 255.
+	for how in ('add_many', 'add', 'slow'):
+		rh = _filled([1.0] * 300, how=how, count_dtype=np.uint8)
+		assert rh.h == {1.0: 300}
+		assert rh.n() == 300
+	
+	rh = _filled([1.0] * 200, count_dtype=np.uint8)
+	rh.add_many([1.0] * 100)
+	assert rh.h == {1.0: 300}
+
+
+def test_RHist_above():
+	# Criterion exactly on, and between, bins.
+	rh = _filled([0.1, 0.2, 0.2, 0.3])
+	assert rh.above(0.2) == 0.75
+	assert rh.above(0.25) == 0.25
+	assert rh.above(0.3) == 0.25
+	assert rh.above(-1) == 1.0
+	assert rh.above(1) == 0.0
+
+
+def test_RHist_float32():
+	import numpy as np
+
+	# float32 data is binned as float64, by every path. 
+	# (In float32, 0.35 * 10 rounds up to bin 0.4.)
+	xs = [np.float32(0.35)]
+	for how in ('add_many', 'add', 'slow'):
+		assert _filled(xs, how=how).h == {0.3: 1}
+
+
+def test_RHist_parallel():
+	import numpy as np
+	import bigstats.hist as hist
+
+	# Count calls to the parallel kernel (when numba is around).
+	calls = []
+	kernel = getattr(hist, '_bincount_parallel', None)
+	if kernel is not None:
+		def counted(*args):
+			calls.append(args[0].size)
+			return kernel(*args)
+		hist._bincount_parallel = counted
+
+	rs = np.random.RandomState(7)
+	try:
+		# A big, dense batch (counted in parallel), and one 
+		# spread thinly over many bins (which isn't).
+		for xs, decimals in (
+				(rs.normal(size=(1 << 16) + 1000), 1),
+				(rs.uniform(-2000, 2000, size=70000), 3)):
+			rh = _filled(xs, decimals=decimals)
+			slow = hist.RHist(name='slow',decimals=decimals)
+			slow._fast = False
+			slow.add_many(xs)
+			assert rh.h == slow.h
+			assert rh.n() == xs.size
+	finally:
+		if kernel is not None:
+			hist._bincount_parallel = kernel
+
+	if kernel is not None:
+		assert calls == [(1 << 16) + 1000]
+
+
+def test_RHist_threads():
+	import numpy as np
+	from concurrent.futures import ThreadPoolExecutor
+	from bigstats.hist import RHist
+
+	# The README recipe: one histogram per stream, one thread each.
+	rs = np.random.RandomState(11)
+	streams = [rs.normal(loc=i,size=20000) for i in range(4)]
+	for fast in (True, False):
+		hists = [RHist(name=str(i),decimals=2) for i in range(len(streams))]
+		for rh in hists:
+			rh._fast = rh._fast and fast
+		with ThreadPoolExecutor(max_workers=len(streams)) as pool:
+			list(pool.map(RHist.add_many, hists, streams))
+
+		for rh, xs in zip(hists, streams):
+			assert rh.h == _filled(xs, decimals=2).h
+			assert np.isclose(rh.mean(), np.round(xs, 2).mean())